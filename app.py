@@ -1,7 +1,16 @@
 import os
 import time
 import re
+import json
+import hashlib
+import logging
+import secrets
+import threading
 import requests
+from collections import deque
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from concurrent.futures import Future, ThreadPoolExecutor
 from flask import Flask, request, jsonify
 from llmproxy import generate, pdf_upload
 from dotenv import load_dotenv
@@ -10,22 +19,228 @@ from dotenv import load_dotenv
 # Configuration
 # ------------------------------------------------------------------------
 load_dotenv()
+# DEBUG output is off unless LOG_LEVEL=DEBUG; messages are only formatted when enabled
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").strip().upper()
+logging.basicConfig(level=logging.getLevelNamesMapping().get(LOG_LEVEL, logging.INFO))
+logger = logging.getLogger(__name__)
+if LOG_LEVEL not in logging.getLevelNamesMapping():
+    # a typo in the config shouldn't stop the app from booting
+    logger.warning("Unknown LOG_LEVEL %r, using INFO", LOG_LEVEL)
+
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
 PDF_PATH = os.path.join(BASE_DIR, 'twips_paper.pdf')
+PAPER_CACHE_PATH = os.path.join(BASE_DIR, 'paper_cache.json')
 
 ROCKET_CHAT_URL = "https://chat.genaiconnect.net"
 BOT_USER_ID = os.getenv("botUserId")
 BOT_AUTH_TOKEN = os.getenv("botToken")
 TA_USERNAME = os.getenv("taUserName")
 MSG_ENDPOINT = os.getenv("msgEndPoint")
+CLASSIFIER_SESSION = "classifier_session"  # llmproxy session shared by classification calls
+TA_USERNAMES = {"Aya": "aya.ismail", "Jiyoon": "jiyoon.choi", "Amanda": "amanda.wu"}
+TA_USERS = frozenset(TA_USERNAMES.values())
+TA_NAMES = {username: name for name, username in TA_USERNAMES.items()}
+TA_BUTTON_MSGS = {f"ask_TA_{name}": name for name in TA_USERNAMES}  # TA menu button -> TA name
+
+# Keep-alive connections to Rocket.Chat with the bot credentials preset.
+# Every call is a POST, which urllib3 never retries on a status code or a
+# read error, so the retries only cover failed connections.
+rocket_session = requests.Session()
+rocket_session.mount("https://", HTTPAdapter(
+    pool_connections=10, pool_maxsize=20,
+    max_retries=Retry(total=3, backoff_factor=0.2)))
+rocket_session.headers.update({
+    "Content-Type": "application/json",
+    "X-Auth-Token": BOT_AUTH_TOKEN,
+    "X-User-Id": BOT_USER_ID,
+})
+
+# Messages that are handled as commands and never graded as follow-up answers
+CMDS = frozenset({"summarize", "generate_followup", "clear_history", "skip_followup"})
+# Button messages that only mean something inside a flow
+BUTTON_MSGS = frozenset({"approve", "modify", "cancel", "send", "refine", "exit", "respond",
+                         "ask_ta", "ask_ta_aya", "ask_ta_jiyoon", "ask_ta_amanda"})
+# Whole questions that can only be asking for the paper's metadata; anything
+# less clear-cut is left to the classifier's metadata flag
+META_RE = re.compile(
+    r"^\s*(who (wrote|are the authors of)|what(?:'s| is) the title of) (the|this) (paper|study)\b[\s?!.]*$", re.I)
+JSON_RE = re.compile(r'\{.*\}', re.S)
+QUOTED_RE = re.compile(r'"([^"]*)"')
+# presentations and extensions only count when they're clearly the class's, since
+# the paper has its own ("TwIPS presentations of tone", "browser extensions")
+LOGISTICS_RE = re.compile(
+    r'\b(deadlines?|due dates?|office\s+hours|late submissions?|syllabus|grading|homework'
+    r'|(our|my|class|project|final) presentations?'
+    r'|extensions? (on|for) (the |my |our |an? )?(project|assignment|homework|deadline|presentation)s?)\b', re.I)
+# words that tie a question to the paper, so logistics keywords alone aren't trusted
+PAPER_RE = re.compile(r'\b(paper|twips|study|participants?|authors?|section|figure|table)\b', re.I)
+GREETING_RE = re.compile(
+    r"^\s*((hi|hello|hey)( there)?|yo|sup|what'?s up|good\s+(morning|afternoon|evening))\b[\s!.?]*$", re.I)
+# short acknowledgements mid-conversation get a one-line reply, not the welcome banner
+ACK_RE = re.compile(r"^\s*(thanks|thank you|thx|ok|okay|got it|cool|lol)\b[\s!.?]*$", re.I)
+CATEGORIES = ("greeting", "content_about_paper", "class_logistics", "off_topic")
 
 summary_cache = {}
+paper_cache = {}  # paper-level results shared by every session, saved to PAPER_CACHE_PATH
+classification_cache = {}
+suggestion_cache = {}  # (session, ta, question, feedback) -> suggested question
+followup_sources = {}  # follow-up button key -> bot message it refers to
 processed_pdf = {}
 pdf_ready = {}
 conversation_history = {}
 ta_msg_to_student_session = {}
+latest_ta_msg = None  # (message id, student) of the last question sent to a TA
+pdf_jobs = {}
+inflight = {}  # generate_response() arguments -> Future of the call in progress
+intro_prefetched = False  # the greeting overview has been prefetched this run
+
+CACHE_SIZE = 1024  # max entries in each bounded cache
+MAX_HISTORY = int(os.getenv("CHAT_HISTORY_MAX", "50"))  # messages kept per session
+SESSION_TTL = 6 * 3600  # seconds before an idle session is dropped
+
+# Background workers for per-session PDF preparation
+EXECUTOR = ThreadPoolExecutor(max_workers=8)
+# Outgoing Rocket.Chat posts, sent after the reply to the student is returned
+NOTIFY_EXECUTOR = ThreadPoolExecutor(max_workers=4)
+PDF_LOCK = threading.Lock()  # guards pdf_jobs so a session gets one PDF job
+SESSION_LOCK = threading.RLock()  # guards session creation, reset and pruning, and suggestion_cache writes
+INFLIGHT_LOCK = threading.Lock()  # guards inflight
+TA_MSG_LOCK = threading.Lock()  # guards the TA message-id map written by NOTIFY_EXECUTOR
+PAPER_CACHE_LOCK = threading.Lock()  # serializes writes of PAPER_CACHE_PATH
+INTRO_LOCK = threading.Lock()  # guards intro_prefetched
 
 app = Flask(__name__)
+# Replies are full of emoji and nested button dicts: emit them as raw UTF-8
+# without key sorting or pretty-printing.
+app.json.ensure_ascii = False
+app.json.sort_keys = False
+app.json.compact = True
+
+# ------------------------------------------------------------------------
+# Prompts
+# ------------------------------------------------------------------------
+DEFAULT_SYSTEM = (
+    "You are a TA chatbot for CS-150. Answer only based on the uploaded paper. "
+    "Keep answers short, encourage users to check sections, and avoid creating your own questions."
+)
+
+CLASSIFIER_SYSTEM = "You are a message classifier for a TA chatbot. Reply only in the format requested."
+
+CLASSIFY_PROMPT = (
+    "Classify the following user message. Return JSON with keys category, difficulty, specificity and metadata.\n\n"
+    "category is exactly one of:\n"
+    "- 'greeting' (if it's just hello/hi/hey)\n"
+    "- 'content_about_paper' (if it asks anything about the uploaded research paper, e.g., methods, results, ideas, implications)\n"
+    "- 'class_logistics' (if it asks about class logistics: deadlines, project presentations, grading, TA office hours, etc.)\n"
+    "- 'off_topic' (if it talks about unrelated things like food, movies, hobbies, etc.)\n\n"
+    "difficulty is exactly one of:\n"
+    "- 'factual' (looking up information)\n"
+    "- 'conceptual' (requires explanation)\n\n"
+    "specificity is exactly one of:\n"
+    "- 'asking_for_details' (if the user is trying to understand a topic, section, or process in the paper that they likely don't know yet; "
+    "these questions are broad, open-ended, or exploratory)\n"
+    "- 'confirming_understanding' (if the user is checking whether something they believe or suspect is correct based on the paper; "
+    "these questions are often yes/no, comparative, or reflect partial understanding)\n\n"
+    "metadata is true only if the message asks for metadata about the uploaded TwIPS paper "
+    "(authors, title, publication details), otherwise false.\n\n"
+    "Return only the JSON object, e.g. "
+    "{{\"category\": \"greeting\", \"difficulty\": \"factual\", \"specificity\": \"asking_for_details\", \"metadata\": false}}.\n\n"
+    "User Message: \"{message}\""
+)
+
+DIFFICULTY_PROMPT = (
+    "Classify the following question as 'factual' or 'conceptual'. "
+    "Factual = lookup info; Conceptual = requires explanation.\n\nQuestion: \"{question}\""
+)
+
+FOLLOWUP_PROMPT = (
+    "You are acting as a TA chatbot helping a student think critically about a research paper.\n\n"
+    "Based on the last response you gave:\n\n"
+    "\"{last_bot_message}\"\n\n"
+    "Generate **one** thoughtful follow-up question that meets these goals:\n"
+    "- Can be either **open-ended** (invites reflection) or **specific** (asks for a particular detail).\n"
+    "- Should **encourage deeper thinking** about the topic.\n"
+    "- Should **feel natural**, like a real conversation.\n"
+    "- Should **stay focused** on the context of the uploaded paper (not general unrelated ideas).\n"
+    "- Keep it **short**, clear, and engaging (1-2 sentences at most).\n"
+    "- Do NOT include any extra commentary or introductions — return only the question itself.\n\n"
+    "Write the best follow-up you can!"
+)
+
+# The static instructions live in the system prompts below and the per-turn
+# text only in the query, so the prompt prefix is identical on every call.
+GRADING_SYSTEM = DEFAULT_SYSTEM + (
+    "\n\nYou are grading a student's reply to a follow-up question you asked. "
+    "Consider the following 2 cases and keep response concise, encouraging, and related to the uploaded paper:\n"
+    "Case 1: If the original follow-up question prompts a concrete answer, evaluate the student's response:\n"
+    "- If correct or mostly correct, confirm warmly and optionally elaborate briefly.\n"
+    "- If partially correct, point out missing parts politely.\n"
+    "- If wrong, gently correct them and guide them where to look in the paper.\n"
+    "Case 2: If the original follow-up question is vague or open-ended, evaluate the student's response:\n"
+    "- If the student provides a concrete answer, confirm warmly and optionally elaborate briefly.\n"
+    "- If the student provides a vague or open-ended answer, gently correct them and guide them where to look in the paper."
+)
+
+GRADING_PROMPT = (
+    "Original follow-up question:\n\n"
+    "\"{last_followup}\"\n\n"
+    "Student's response:\n\n"
+    "\"{message}\""
+)
+
+LOGISTICS_SYSTEM = DEFAULT_SYSTEM + (
+    "\n\nThe student is asking about class logistics. "
+    "Give a short, friendly, 1-2 sentence general tip, but do not make up specific class policies. "
+    "If unsure, encourage them to ask the human TA for details."
+)
+
+# Answers to questions about the paper, picked by the question's specificity and
+# difficulty; the question itself goes in PAPER_QUESTION_PROMPT
+TEASER_SYSTEM = DEFAULT_SYSTEM + (
+    "\n\nThe student is asking a general question to learn more about the paper. "
+    "Give a short teaser (1 sentence) hinting at the answer **only if** it's clearly stated in the paper. "
+    "Then, point the student to the **specific section title** that most specifically contains the answer "
+    "(ie. 4.1 Participant Recruiting), and bold it using Markdown (**like this**)."
+)
+
+FACTUAL_SYSTEM = DEFAULT_SYSTEM + "\n\nAnswer the student's question factually."
+
+CONCEPTUAL_SYSTEM = DEFAULT_SYSTEM + (
+    "\n\nThe student is checking their understanding of the paper. "
+    "Confirm if their understanding is correct. "
+    "Then, respond with the correct answer of this conceptual question in 2-3 sentences based on the paper. "
+    "Only include information you are confident is accurate."
+)
+
+PAPER_QUESTION_PROMPT = "The student asked: \"{message}\""
+
+METADATA_SYSTEM = (
+    "You are a TA chatbot answering factual metadata questions about the uploaded TwIPS paper. "
+    "ONLY use the title page and first page of the paper. "
+    "Ignore all references or citations. "
+    "If the requested information (like authorship or title) is not clearly stated, say so. "
+    "Answer the student's question based solely on the front matter (title page and first page) "
+    "of the uploaded TwIPS paper. If the information is unclear, say so politely."
+)
+
+OFF_TOPIC_TEXT = "🚫 That seems off-topic! Let's focus on the research paper or class logistics."
+STALE_BUTTON_TEXT = "That button is no longer active. Ask me a question about the paper or use the buttons below!"
+ACK_TEXT = "👍 Anytime! Ask me another question about the paper whenever you're ready."
+FALLBACK_TEXT = "❓ I didn't quite catch that. Try asking about the paper!"
+
+INTRO_PROMPT = "Give a one-line overview: 'This week's paper discusses...'"
+
+GREETING_TEMPLATE = (
+    "**Hello! 👋 I am the TA chatbot for CS-150: Generative AI for Social Impact. 🤖**\n\n"
+    "I'm here to help you *critically analyze ONLY this week's* research paper, which I *encourage you to read* before interacting with me. "
+    "I'll guide you to the key sections and ask thought-provoking questions—but I won't just hand you the answers. 🤫\n\n"
+    "**{intro}**\n\n"
+    "If there's a question I can't fully answer, I'll prompt you to forward it to your TA. "
+    "Please ask a question about the paper now or click one of the buttons below! "
+    "You have two buttons to choose from:\n"
+    "- 📄 **Quick Summary** - Get a concise 3-4 sentence overview of the paper's main objectives and findings.\n"
+    "- 🧑‍🏫 **Ask TA** - Send your question to a human TA if you'd like extra help.\n\n"
+)
 
 # ------------------------------------------------------------------------
 # Utilities
@@ -34,13 +249,124 @@ def get_session_id(data):
     user = data.get("user_name", "unknown_user").strip().lower()
     return f"session_{user}_twips_research"
 
-def upload_pdf_if_needed(pdf_path, session_id):
+def normalize(text):
+    return " ".join(text.lower().split())
+
+def cache_put(cache, key, value):
+    """
+    Insert into a plain dict cache, evicting the oldest entry when full.
+    """
+    if len(cache) >= CACHE_SIZE:
+        cache.pop(next(iter(cache)), None)
+    cache[key] = value
+
+def is_llm_error(response):
+    # llmproxy reports failures as plain strings instead of raising
+    return response.startswith(("Error:", "An error occurred"))
+
+def load_pdf():
+    try:
+        with open(PDF_PATH, 'rb') as f:
+            return f.read()
+    except OSError:
+        return None
+
+def load_paper_cache():
+    """
+    Load paper-level results saved by a previous run, if they were made for
+    the same PDF.
+    """
+    try:
+        with open(PAPER_CACHE_PATH, encoding='utf-8') as f:
+            saved = json.load(f)
+    except (OSError, ValueError):
+        return {}
+    if not PDF_HASH or saved.get("pdf") != PDF_HASH:
+        return {}
+    return saved.get("entries", {})
+
+def save_paper_cache():
+    """
+    Write paper_cache to disk. Saves can come from request threads and
+    EXECUTOR at once, so each writes a snapshot to a temporary file and
+    swaps it into place.
+    """
+    if not PDF_HASH:
+        return
+    tmp_path = PAPER_CACHE_PATH + ".tmp"
+    with PAPER_CACHE_LOCK:
+        try:
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump({"pdf": PDF_HASH, "entries": dict(paper_cache)}, f, ensure_ascii=False)
+            os.replace(tmp_path, PAPER_CACHE_PATH)
+        except OSError as e:
+            logger.error("Could not save paper cache: %s", e)
+
+# read the paper once; every session uploads these bytes, and the summary etc.
+# only need regenerating when they change
+PDF_BYTES = load_pdf()
+PDF_HASH = hashlib.blake2b(PDF_BYTES, digest_size=16).hexdigest() if PDF_BYTES else None
+paper_cache.update(load_paper_cache())
+
+def reset_session(session_id):
+    with SESSION_LOCK:
+        conversation_history.pop(session_id, None)
+        summary_cache.pop(session_id, None)
+        processed_pdf.pop(session_id, None)
+        pdf_ready.pop(session_id, None)
+        pdf_jobs.pop(session_id, None)
+        for key in list(suggestion_cache):
+            if key[0] == session_id:
+                suggestion_cache.pop(key, None)
+
+def prune_sessions():
+    """
+    Drop sessions that have been idle for longer than SESSION_TTL.
+    """
+    cutoff = time.time() - SESSION_TTL
+    with SESSION_LOCK:
+        for sid, session in list(conversation_history.items()):
+            if session.get("last_seen", 0) < cutoff:
+                reset_session(sid)
+
+def get_session(session_id, warm=True):
+    """
+    Return the conversation state for a session, creating it and resetting
+    the session's caches on first use. All session state is created here.
+    A new student session starts preparing the paper unless warm is False;
+    ensure_pdf_processed starts it later if the session does need it.
+    """
+    with SESSION_LOCK:
+        session = conversation_history.get(session_id)
+        if session is None:
+            prune_sessions()
+            reset_session(session_id)
+            session = conversation_history[session_id] = {
+                "messages": deque(maxlen=MAX_HISTORY),
+                "first_token": extract_first_token(session_id),  # Rocket.Chat username
+            }
+            # TAs only relay answers, so their sessions never need the paper
+            if warm and session["first_token"] not in TA_USERS:
+                warm_pdf(session_id)
+                prefetch_intro(session_id)
+        session["last_seen"] = time.time()
+    return session
+
+def append_bot_message(session_id, text):
+    """
+    Record a bot reply and remember it as the session's latest bot message.
+    """
+    session = conversation_history[session_id]
+    session["messages"].append(("bot", text))
+    session["last_bot_message"] = text
+
+def upload_pdf_if_needed(session_id):
     if processed_pdf.get(session_id):
         return True
-    if not os.path.exists(pdf_path):
+    if PDF_BYTES is None:
         return False
     try:
-        response = pdf_upload(path=pdf_path, session_id=session_id, strategy="smart")
+        response = pdf_upload(path=PDF_PATH, session_id=session_id, strategy="smart", data=PDF_BYTES)
         if "Successfully uploaded" in response:
             processed_pdf[session_id] = True
             return True
@@ -48,37 +374,124 @@ def upload_pdf_if_needed(pdf_path, session_id):
     except Exception:
         return False
 
-def wait_for_pdf_ready(session_id, max_attempts=15, delay=2):
-    print(f"DEBUG: Waiting for PDF\n")
+def wait_for_pdf_ready(session_id, max_attempts=6, delay=0.5, max_delay=4):
+    logger.debug("Waiting for PDF")
     if pdf_ready.get(session_id):
         return True
     for _ in range(max_attempts):
-        response = generate_response("", "What is the title of the uploaded paper?", session_id)
-        if "twips" in response.lower():
+        # the probe only needs retrieval, not the chat history
+        response = generate_response("", "What is the title of the uploaded paper?", session_id, lastk=0)
+        if "twips" in response.casefold():
             pdf_ready[session_id] = True
             return True
+        # back off (0.5, 1, 2, 4s...) so a slow index costs a few probes rather than fifteen
         time.sleep(delay)
+        delay = min(delay * 2, max_delay)
     return False
 
-def ensure_pdf_processed(session_id):
-    print(f"DEBUG: PDF processed\n")
-    return upload_pdf_if_needed(PDF_PATH, session_id) and wait_for_pdf_ready(session_id)
+def process_pdf(session_id):
+    return upload_pdf_if_needed(session_id) and wait_for_pdf_ready(session_id)
 
-def generate_response(system, prompt, session_id):
+def warm_pdf(session_id):
+    """
+    Start uploading and indexing the paper for a session in the background,
+    so it overlaps with the first request's classification.
+    """
+    with PDF_LOCK:
+        if session_id not in pdf_jobs:
+            pdf_jobs[session_id] = EXECUTOR.submit(process_pdf, session_id)
+        return pdf_jobs[session_id]
+
+def ensure_pdf_processed(session_id):
+    logger.debug("PDF processed")
+    job = warm_pdf(session_id)
+    ready = job.result()
+    if not ready:
+        # let the next request retry the upload, unless another one already did
+        with PDF_LOCK:
+            if pdf_jobs.get(session_id) is job:
+                pdf_jobs.pop(session_id)
+    return ready
+
+def generate_response(system, prompt, session_id, lastk=5, rag=True):
     if not system:
-        system = ("You are a TA chatbot for CS-150. Answer only based on the uploaded paper. "
-                  "Keep answers short, encourage users to check sections, and avoid creating your own questions.")
-    response = generate(model='4o-mini', system=system, query=prompt, session_id=session_id, temperature=0.0,
-                        lastk=5, rag_usage=True, rag_threshold=0.1, rag_k=5)
+        system = DEFAULT_SYSTEM
+    # identical calls already in flight (e.g. a double-clicked button) share one LLM request
+    key = (system, prompt, session_id, lastk, rag)
+    with INFLIGHT_LOCK:
+        future = inflight.get(key)
+        leader = future is None
+        if leader:
+            future = inflight[key] = Future()
+    if not leader:
+        return future.result()
 
-    if isinstance(response, dict):
-        return response.get("response", "").strip()
-    return response.strip()
+    try:
+        response = generate(model='4o-mini', system=system, query=prompt, session_id=session_id, temperature=0.0,
+                            lastk=lastk, rag_usage=rag, rag_threshold=0.1, rag_k=5 if rag else 0)
+        if isinstance(response, dict):
+            response = response.get("response", "")
+        future.set_result(response.strip())
+    except Exception as e:
+        future.set_exception(e)
+        raise
+    finally:
+        with INFLIGHT_LOCK:
+            inflight.pop(key, None)
+    return future.result()
+
+def generate_classifier(prompt):
+    """
+    Run a classification prompt. Labelling a message needs neither the paper
+    nor the chat history, so these calls skip retrieval and use their own
+    llmproxy session instead of adding turns to the student's history.
+    """
+    return generate_response(CLASSIFIER_SYSTEM, prompt, CLASSIFIER_SESSION, lastk=0, rag=False)
+
+def paper_intro(session_id):
+    """
+    One-line overview of the paper for the greeting. It is the same for every
+    student, so it is generated once per paper and kept in paper_cache.
+    """
+    intro = paper_cache.get("intro")
+    if intro:
+        return intro
+    ready = ensure_pdf_processed(session_id)
+    return generate_intro(session_id, ready)
+
+def generate_intro(session_id, ready):
+    intro = paper_cache.get("intro")
+    if intro:
+        return intro
+    # lastk=0: the overview doesn't depend on the student's conversation
+    intro = generate_response("", INTRO_PROMPT, session_id, lastk=0)
+    if ready and not is_llm_error(intro):
+        paper_cache["intro"] = intro
+        save_paper_cache()
+    return intro
+
+def prefetch_intro(session_id):
+    """
+    Have the greeting's overview ready before the student says hi. Only the
+    first session of a run prefetches it, once its PDF job has finished, so
+    no EXECUTOR worker sits waiting on another job.
+    """
+    global intro_prefetched
+    with INTRO_LOCK:
+        if intro_prefetched or "intro" in paper_cache:
+            return
+        intro_prefetched = True
+    warm_pdf(session_id).add_done_callback(lambda job: submit_intro(session_id, job))
+
+def submit_intro(session_id, job):
+    # runs when the session's PDF job finishes; if the upload failed, the
+    # greeting generates the overview itself
+    if job.exception() is None and job.result():
+        EXECUTOR.submit(generate_intro, session_id, True)
 
 def generate_paper_response(system, prompt, session_id):
     if not system:
-        system = ("You are a TA chatbot for CS-150. Answer only based on the uploaded paper. "
-                  "Keep answers short, encourage users to check sections, and avoid creating your own questions.")
+        system = DEFAULT_SYSTEM
     response = generate(model='4o-mini', system=system, query=prompt, session_id=session_id, temperature=0.0,
                         lastk=5, rag_usage=True, rag_threshold=0.01, rag_k=10)
 
@@ -109,166 +522,209 @@ def generate_paper_response(system, prompt, session_id):
 #         }
 
 
-def classify_query(message, session_id):
-    prompt = (f"Classify the following user question into exactly one of:\n\n"
-              "- 'greeting' (if it's just hello/hi/hey)\n"
-              "- 'content_about_paper' (if it asks anything about the uploaded research paper, e.g., methods, results, ideas, implications)\n"
-              "- 'class_logistics' (if it asks about class logistics: deadlines, project presentations, grading, TA office hours, etc.)\n"
-              "- 'off_topic' (if it talks about unrelated things like food, movies, hobbies, etc.)\n\n"
-              "Return only the label itself.\n\n"
-              f"User Message: \"{message}\"")
-    
-    classification = generate_response("", prompt, session_id).lower().strip()
-    print(f"DEBUG: Classification: ", classification)
-    
-    if "greeting" in classification:
-        return "greeting"
-    if "content_about_paper" in classification:
-        return "content_about_paper"
-    if "class_logistics" in classification:
-        return "class_logistics"
-    if "off_topic" in classification:
-        return "off_topic"
-    return "content_about_paper"  # safe fallback
-
-
-def classify_difficulty(question, session_id):
-    prompt = (f"Classify the following question as 'factual' or 'conceptual'. "
-              f"Factual = lookup info; Conceptual = requires explanation.\n\nQuestion: \"{question}\"")
-    difficulty = generate_response("", prompt, session_id).lower()
-    return "factual" if "factual" in difficulty else "conceptual"
-
-def classify_specificity(question: str, session_id: str) -> str:
+def classify(message):
     """
-    Use the LLM to classify a question as 'general' or 'specific'.
+    Classify a message's topic, difficulty, specificity and whether it asks for
+    paper metadata with a single LLM call.
+    Returns a (category, difficulty, specificity, is_metadata) tuple.
     """
-    prompt = (
-        "Classify the following question based on its intent:\n\n"
-        "- 'asking_for_details' → if the user is trying to understand a topic, section, or process in the paper that they likely don't know yet. "
-        "These questions are broad, open-ended, or exploratory.\n"
-        "- 'confirming_understanding' → if the user is checking whether something they believe or suspect is correct based on the paper. "
-        "These questions are often yes/no, comparative, or reflect partial understanding.\n\n"
-        f"Question: \"{question}\"\n\n"
-        "Respond with only one word: 'asking_for_details' or 'confirming_understanding'."
-    )
-    response = generate_response("", prompt, session_id)
-    print(f"DEBUG: Specificity classifed as: ", response)
-    return response.strip().lower()
+    # bare greetings don't need the LLM to tell what they are
+    if GREETING_RE.match(message):
+        logger.debug("Greeting matched locally")
+        return "greeting", "factual", "asking_for_details", False
+    if ACK_RE.match(message):
+        return "acknowledgement", "factual", "asking_for_details", False
+    # so are unambiguous course-logistics questions
+    if LOGISTICS_RE.search(message) and not PAPER_RE.search(message):
+        logger.debug("Logistics matched locally")
+        return "class_logistics", "factual", "asking_for_details", False
+
+    # the labels depend only on the message text, so repeats skip the LLM
+    key = ("classify", normalize(message))
+    if key in classification_cache:
+        logger.debug("Classification cache hit: %s", classification_cache[key])
+        return classification_cache[key]
+
+    prompt = CLASSIFY_PROMPT.format(message=message)
+
+    response = generate_classifier(prompt)
+    logger.debug("Classification: %s", response)
+    if is_llm_error(response):
+        return "content_about_paper", "conceptual", "confirming_understanding", False
 
+    try:
+        parsed = json.loads(JSON_RE.search(response).group(0))
+        category = str(parsed.get("category", "")).lower()
+        difficulty = str(parsed.get("difficulty", "")).lower()
+        specificity = str(parsed.get("specificity", "")).lower()
+        is_metadata = str(parsed.get("metadata", "")).lower() == "true"
+    except (AttributeError, ValueError):
+        # not valid JSON, fall back to scanning the raw text for the labels
+        category = difficulty = specificity = response.lower()
+        is_metadata = False
+
+    if category in CATEGORIES:
+        label = category
+    else:
+        label = next((c for c in CATEGORIES if c in category), "content_about_paper")  # safe fallback
+    result = (label,
+              "factual" if "factual" in difficulty else "conceptual",
+              "asking_for_details" if "asking_for_details" in specificity else "confirming_understanding",
+              is_metadata)
+    cache_put(classification_cache, key, result)
+    return result
+
+
+def classify_difficulty(question):
+    key = ("difficulty", normalize(question))
+    if key in classification_cache:
+        return classification_cache[key]
+    prompt = DIFFICULTY_PROMPT.format(question=question)
+    response = generate_classifier(prompt)
+    difficulty = "factual" if "factual" in response.lower() else "conceptual"
+    if not is_llm_error(response):
+        cache_put(classification_cache, key, difficulty)
+    return difficulty
 
 def generate_followup(session_id, override_last_bot=None):
     if override_last_bot:
         last_bot_message = override_last_bot
     else:
-        history = conversation_history.get(session_id, {}).get("messages", [])
-        last_bot_message = next(
-            (msg for speaker, msg in reversed(history) if speaker == "bot"),
-            None
-        )
+        last_bot_message = conversation_history.get(session_id, {}).get("last_bot_message")
     # graceful fallback
     if not last_bot_message:
         return ("I need a little context first — ask me something about "
                 "the paper, then press **Get a Follow-up Question**! 😊")
 
-    print(f"DEBUG: creating followup question \n")
-    prompt = (
-        f"You are acting as a TA chatbot helping a student think critically about a research paper.\n\n"
-        f"Based on the last response you gave:\n\n"
-        f"\"{last_bot_message}\"\n\n"
-        f"Generate **one** thoughtful follow-up question that meets these goals:\n"
-        f"- Can be either **open-ended** (invites reflection) or **specific** (asks for a particular detail).\n"
-        f"- Should **encourage deeper thinking** about the topic.\n"
-        f"- Should **feel natural**, like a real conversation.\n"
-        f"- Should **stay focused** on the context of the uploaded paper (not general unrelated ideas).\n"
-        f"- Keep it **short**, clear, and engaging (1-2 sentences at most).\n"
-        f"- Do NOT include any extra commentary or introductions — return only the question itself.\n\n"
-        f"Write the best follow-up you can!"
-    )
+    logger.debug("creating followup question")
+    prompt = FOLLOWUP_PROMPT.format(last_bot_message=last_bot_message)
 
     followup = generate_response("", prompt, session_id)
     return followup.strip()
 
+# Static attachments shared by every response; never mutated
+SUMMARY_BUTTON = {
+    "actions": [{
+        "type": "button",
+        "text": "📄 Quick Summary",
+        "msg": "summarize",
+        "msg_in_chat_window": True,
+        "msg_processing_type": "sendMessage"
+    }]
+}
+ASK_TA_BUTTON = {
+    "actions": [{
+        "type": "button",
+        "text": "👩‍🏫 Ask a TA",
+        "msg": "ask_TA",
+        "msg_in_chat_window": True,
+        "msg_processing_type": "sendMessage"
+    }]
+}
+SKIP_FOLLOWUP_BUTTON = {
+    "actions": [{
+        "type": "button",
+        "text": "❌ Skip",
+        "msg": "skip_followup",
+        "msg_in_chat_window": True,
+        "msg_processing_type": "sendMessage"
+    }]
+}
+TA_CONFIRM_BUTTONS = {
+    "actions": [
+        {
+            "type": "button",
+            "text": "✅ Yes, Ask TA",
+            "msg": "ask_TA",
+            "value": "yes",
+            "msg_in_chat_window": True,
+            "msg_processing_type": "sendMessage"
+        },
+        {
+            "type": "button",
+            "text": "❌ No",
+            "msg": "ask_TA",
+            "value": "no",
+            "msg_in_chat_window": True,
+            "msg_processing_type": "sendMessage"
+        }
+    ]
+}
+
 def show_buttons(text, session_id, summary_button=False, followup_button=False):
-    attachments = []
-    if summary_button:
-        attachments.append({
-            "actions": [{
-                "type": "button",
-                "text": "📄 Quick Summary",
-                "msg": "summarize",
-                "msg_in_chat_window": True,
-                "msg_processing_type": "sendMessage"
-            }]
-        })
+    attachments = [SUMMARY_BUTTON] if summary_button else []
     if followup_button:
-        # embed the last bot message after a special prefix
-        encoded = text.replace("\n", "\\n").replace('"', '\\"')
+        # keep the bot message server-side; the button only carries its key
+        key = secrets.token_urlsafe(8)
+        cache_put(followup_sources, key, text)
         attachments.append({
             "actions": [{
                 "type": "button",
                 "text": "🎲 Get a Follow-up Question",
-                "msg": f"__FOLLOWUP__ | {encoded}",
+                "msg": f"__FOLLOWUP__ | {key}",
                 "msg_in_chat_window": True,
                 "msg_processing_type": "sendMessage"
             }]
         })
-    attachments.append({
-        "actions": [{
-            "type": "button",
-            "text": "👩‍🏫 Ask a TA",
-            "msg": "ask_TA",
-            "msg_in_chat_window": True,
-            "msg_processing_type": "sendMessage"
-        }]
-    })
+    attachments.append(ASK_TA_BUTTON)
     return {"text": text, "session_id": session_id, "attachments": attachments}
 
-def build_TA_button():
-    return {
-        "text": "Select a TA to ask your question:",
-        "attachments": [
-            {
-                "title": "Choose a TA",
-                "actions": [
-                    {
-                        "type": "button",
-                        "text": "Ask TA Aya",
-                        "msg": "ask_TA_Aya",
-                        "msg_in_chat_window": True,
-                        "msg_processing_type": "sendMessage"
-                    },
-                    {
-                        "type": "button",
-                        "text": "Ask TA Jiyoon",
-                        "msg": "ask_TA_Jiyoon",
-                        "msg_in_chat_window": True,
-                        "msg_processing_type": "sendMessage"
-                    },
-                    {
-                        "type": "button",
-                        "text": "Ask TA Amanda",
-                        "msg": "ask_TA_Amanda",
-                        "msg_in_chat_window": True,
-                        "msg_processing_type": "sendMessage"
-                    }
-                ]
-            }
-        ]
-    }
+TA_MENU = {
+    "text": "Select a TA to ask your question:",
+    "attachments": [
+        {
+            "title": "Choose a TA",
+            "actions": [
+                {
+                    "type": "button",
+                    "text": "Ask TA Aya",
+                    "msg": "ask_TA_Aya",
+                    "msg_in_chat_window": True,
+                    "msg_processing_type": "sendMessage"
+                },
+                {
+                    "type": "button",
+                    "text": "Ask TA Jiyoon",
+                    "msg": "ask_TA_Jiyoon",
+                    "msg_in_chat_window": True,
+                    "msg_processing_type": "sendMessage"
+                },
+                {
+                    "type": "button",
+                    "text": "Ask TA Amanda",
+                    "msg": "ask_TA_Amanda",
+                    "msg_in_chat_window": True,
+                    "msg_processing_type": "sendMessage"
+                }
+            ]
+        }
+    ]
+}
+
+def build_TA_button(session_id):
+    return {**TA_MENU, "session_id": session_id}
 
 # -----------------------------------------------------------------------------
 # TA Messaging Function (send message to TA)
 # -----------------------------------------------------------------------------
+def log_notify_error(future):
+    if future.exception():
+        logger.error("Background Rocket.Chat post failed: %s", future.exception())
+
+def notify(fn, *args):
+    """
+    Run a Rocket.Chat post on NOTIFY_EXECUTOR without blocking the reply,
+    logging anything it raises.
+    """
+    future = NOTIFY_EXECUTOR.submit(fn, *args)
+    future.add_done_callback(log_notify_error)
+    return future
+
 def send_direct_message_to_TA(question, session_id, ta_username):
     """
     Send a direct message to the TA using Rocket.Chat.
     """
-    msg_url = MSG_ENDPOINT
-    headers = {
-        "Content-Type": "application/json",
-        "X-Auth-Token": BOT_AUTH_TOKEN,
-        "X-User-Id": BOT_USER_ID,
-    }
+    global latest_ta_msg
     message_text = f"Student '{session_id}' asks: {question}"
     payload = {
         "channel": f"@{ta_username}",
@@ -287,19 +743,21 @@ def send_direct_message_to_TA(question, session_id, ta_username):
         }]
     }
     try:
-        response = requests.post(msg_url, json=payload, headers=headers)
+        response = rocket_session.post(MSG_ENDPOINT, json=payload, timeout=(3, 10))
         resp_data = response.json()
-        print("DEBUG: Direct message sent:", resp_data)
+        logger.debug("Direct message sent: %s", resp_data)
         # Extract the unique message _id returned from Rocket.Chat:
         if resp_data.get("success") and "message" in resp_data:
             message_id = resp_data["message"].get("_id")
             if message_id:
                 # Save the mapping from message id to student session.
-                ta_msg_to_student_session[message_id] = session_id
-                print(f"DEBUG: Mapped message id {message_id} to session {session_id}")
+                with TA_MSG_LOCK:
+                    cache_put(ta_msg_to_student_session, message_id, session_id)
+                    latest_ta_msg = (message_id, session_id)
+                logger.debug("Mapped message id %s to session %s", message_id, session_id)
         # print("DEBUG: Direct message sent:", response.json())
     except Exception as e:
-        print("DEBUG: Error sending direct message to TA:", e)
+        logger.error("Error sending direct message to TA: %s", e)
 
 # -----------------------------------------------------------------------------
 # TA-student Messaging Function (forward question to student)
@@ -316,13 +774,18 @@ def extract_first_token(session_id):
     # Then, split and get the first token.
     return user_part.split('_')[0]
 
+# Only the Manual Edit button depends on the question; the rest never change
+APPROVE_ACTION = {"type":"button","text":"✅ Approve","msg":"approve","msg_in_chat_window":True,"msg_processing_type":"sendMessage"}
+MODIFY_ACTION = {"type":"button","text":"✏️ Modify","msg":"modify","msg_in_chat_window":True,"msg_processing_type":"sendMessage"}
+CANCEL_ACTION = {"type":"button","text":"❌ Cancel","msg":"cancel","msg_in_chat_window":True,"msg_processing_type":"sendMessage"}
+
 def build_refinement_buttons(q_flow):
     base = q_flow.get("suggested_question") or q_flow["raw_question"]
     return {
       "attachments": [{
         "actions": [
-          {"type":"button","text":"✅ Approve","msg":"approve","msg_in_chat_window":True,"msg_processing_type":"sendMessage"},
-          {"type":"button","text":"✏️ Modify","msg":"modify","msg_in_chat_window":True,"msg_processing_type":"sendMessage"},
+          APPROVE_ACTION,
+          MODIFY_ACTION,
           {
             "type":"button",
             "text":"📝 Manual Edit",
@@ -330,7 +793,7 @@ def build_refinement_buttons(q_flow):
             "msg_in_chat_window": True,
             "msg_processing_type": "respondWithMessage"
           },
-          {"type":"button","text":"❌ Cancel","msg":"cancel","msg_in_chat_window":True,"msg_processing_type":"sendMessage"}
+          CANCEL_ACTION
         ]
       }]
     }
@@ -358,14 +821,8 @@ def build_manual_edit_buttons(prefill_text):
     }
 
 def forward_message_to_student(ta_response, session_id, student_session_id):
-    msg_url = MSG_ENDPOINT
-    headers = {
-        "Content-Type": "application/json",
-        "X-Auth-Token": BOT_AUTH_TOKEN,
-        "X-User-Id": BOT_USER_ID,
-    }
     
-    ta = "Aya" if session_id == "session_aya.ismail_twips_research" else "Jiyoon" 
+    ta = TA_NAMES.get(extract_first_token(session_id), "Jiyoon")
     message_text = (
 
     f"Your TA {ta} says: '{ta_response} 💬'\n\n"
@@ -375,9 +832,10 @@ def forward_message_to_student(ta_response, session_id, student_session_id):
     "https://piazza.com/class/m5wtfh955vwb8/create\n\n"
     )
     
-    student = extract_first_token(student_session_id)
-    print(f"DEBUG****: ta session id: {session_id}")
-    print(f"DEBUG: Forwarding message to student {student}: {message_text}")
+    student = conversation_history.get(student_session_id, {}).get("first_token") or \
+        extract_first_token(student_session_id)
+    logger.debug("ta session id: %s", session_id)
+    logger.debug("Forwarding message to student %s: %s", student, message_text)
     
     payload = {
         "channel": f"@{student}",
@@ -385,18 +843,24 @@ def forward_message_to_student(ta_response, session_id, student_session_id):
     }
     
     try:
-        response = requests.post(msg_url, json=payload, headers=headers)
-        print("DEBUG: TA Response forwarded to student:", response.json())
+        response = rocket_session.post(MSG_ENDPOINT, json=payload, timeout=(3, 10))
+        logger.debug("TA Response forwarded to student: %s", response.text)
     except Exception as e:
-        print("DEBUG: Error sending TA response to student:", e)
+        logger.error("Error sending TA response to student: %s", e)
         
 
 def generate_suggested_question(session_id, student_question, feedback=None):
     """
     Generate a rephrased and clearer version of the student's question.
     """
-    print(f"DEBUG: session_id inside generate_suggested_question: {session_id}")
+    logger.debug("session_id inside generate_suggested_question: %s", session_id)
     ta_name = conversation_history[session_id]["question_flow"]["ta"]
+    # re-clicking refine with the same inputs shouldn't cost another LLM call
+    key = (session_id, ta_name, normalize(student_question), normalize(feedback or ""))
+    if key in suggestion_cache:
+        logger.debug("Suggested question cache hit")
+        return suggestion_cache[key]
+
     if feedback:
         prompt = (
             f"""Original question: "{student_question}"\n"""
@@ -439,21 +903,109 @@ def generate_suggested_question(session_id, student_question, feedback=None):
          result = response.strip()
          
     # Optionally extract a quoted sentence if present
-    match = re.search(r'"(.*?)"', result)
+    match = QUOTED_RE.search(result)
     suggested_question_clean = match.group(1) if match else result
-    print(f"DEBUG: Suggested question: {result}")
-    print("END OF SUGGESTED QUESTION")
+    logger.debug("Suggested question: %s", result)
+    if not is_llm_error(result):
+        # reset_session walks suggestion_cache under SESSION_LOCK
+        with SESSION_LOCK:
+            cache_put(suggestion_cache, key, (result, suggested_question_clean))
     return result, suggested_question_clean
 
+# ------------------------------------------------------------------------
+# Message Handlers
+# ------------------------------------------------------------------------
+# Each handler answers one classification; labels is the tuple from classify().
+def handle_greeting(message, session_id, labels):
+    intro = paper_intro(session_id)
+
+    greeting_msg = GREETING_TEMPLATE.format(intro=intro)
+
+    append_bot_message(session_id, greeting_msg)
+    return jsonify(show_buttons(greeting_msg, session_id, summary_button=True))
+
+def handle_paper_question(message, session_id, labels):
+    _, difficulty, specificity, is_metadata = labels
+    ensure_pdf_processed(session_id)
+
+    # metadata questions (authors, title, publication, etc.) are flagged by the classifier
+    is_metadata = is_metadata or bool(META_RE.match(message))
+
+    if is_metadata:
+        # Very strict system prompt for metadata
+        answer = generate(
+            model='4o-mini',
+            system=METADATA_SYSTEM,
+            query=message,
+            session_id=session_id,
+            temperature=0.0,
+            lastk=5,
+            rag_usage=True,
+            rag_threshold=0.02,
+            rag_k=10
+        )
+        answer = answer["response"].strip() if isinstance(answer, dict) else answer.strip()
+    else:
+        if specificity == "asking_for_details":
+            logger.debug("Generating Elusive response about Paper...")
+            answer = generate_paper_response(TEASER_SYSTEM, PAPER_QUESTION_PROMPT.format(message=message), session_id)
+
+        else:
+            if difficulty == "factual":
+                logger.debug("Generating Factual response about Paper...")
+                answer = generate_paper_response(FACTUAL_SYSTEM, PAPER_QUESTION_PROMPT.format(message=message), session_id)
+            else:
+                logger.debug("Generating Detailed response about Paper...")
+                answer = generate_paper_response(CONCEPTUAL_SYSTEM, PAPER_QUESTION_PROMPT.format(message=message), session_id)
+
+
+    append_bot_message(session_id, answer)
+    return jsonify(show_buttons(answer, session_id, followup_button=True))
+
+def handle_logistics(message, session_id, labels):
+    # Step 1: Try to give a short chatbot answer first
+    short_answer = generate_response(LOGISTICS_SYSTEM, f"The student asked: \"{message}\"", session_id, rag=False)
+    append_bot_message(session_id, short_answer)
+
+    # Step 2: THEN offer human TA help
+    conversation_history[session_id]["awaiting_ta_confirmation"] = True
+
+    return jsonify({
+        "text": f"{short_answer}\n\nWould you like to ask your TA for more clarification? 🧐",
+        "attachments": [TA_CONFIRM_BUTTONS],
+        "session_id": session_id
+    })
+
+def handle_off_topic(message, session_id, labels):
+    append_bot_message(session_id, OFF_TOPIC_TEXT)
+    return jsonify(show_buttons(OFF_TOPIC_TEXT, session_id))
+
+def handle_acknowledgement(message, session_id, labels):
+    append_bot_message(session_id, ACK_TEXT)
+    return jsonify(show_buttons(ACK_TEXT, session_id))
+
+def handle_fallback(message, session_id, labels):
+    append_bot_message(session_id, FALLBACK_TEXT)
+    return jsonify(show_buttons(FALLBACK_TEXT, session_id))
+
+HANDLERS = {
+    "greeting": handle_greeting,
+    "content_about_paper": handle_paper_question,
+    "class_logistics": handle_logistics,
+    "off_topic": handle_off_topic,
+    "acknowledgement": handle_acknowledgement,
+}
+
 # ------------------------------------------------------------------------
 # Flask Route
 # ------------------------------------------------------------------------
 @app.route('/query', methods=['POST'])
 def query():
-    print("DEBUG: Handling query...")
+    logger.debug("Handling query...")
     data = request.get_json() or request.form
     user = data.get("user_name", "Unknown")
     message = data.get("text", "").strip()
+    msg_lc = message.lower()
 
     session_id = data.get("session_id") or get_session_id(data)
 
@@ -463,59 +1015,48 @@ def query():
     # ────────────────────────────────
     # Human‐TA “Respond” button
     # ────────────────────────────────
-    if message.lower() == "respond":
-        print("DEBUG: Respond button clicked")
-        msg_id       = data.get("message", {}).get("_id")
-        student_sess = ta_msg_to_student_session.get(msg_id)
-        print("student_sess: ", student_sess)
-        if student_sess:
-            print(f"DEBUG: Responding to student session {student_sess}")
-            conversation_history.setdefault(student_sess, {"messages":[]})
-            conversation_history[student_sess]["awaiting_ta_response"] = True
+    if msg_lc == "respond":
+        logger.debug("Respond button clicked")
+        msg_id = data.get("message", {}).get("_id")
+        student_username = ta_msg_to_student_session.get(msg_id)
+        if student_username:
+            # the map holds the student's username; their state lives under the session id
+            student_sess = get_session_id({"user_name": student_username})
+            logger.debug("Responding to student session %s", student_sess)
+            # only flags the student's session; it needs no paper upload
+            get_session(student_sess, warm=False)["awaiting_ta_response"] = True
             return jsonify({
                 "text": "Please type your response to the student.",
                 "session_id": student_sess
             })
 
-    if message.lower() == "skip_followup":
-        conversation_history[session_id]["awaiting_followup_response"] = False
-        conversation_history[session_id].pop("last_followup_question", None)
+    sess = get_session(session_id)
+
+    if msg_lc == "skip_followup":
+        sess["awaiting_followup_response"] = False
+        sess.pop("last_followup_question", None)
         text = "No worries! Let's continue whenever you're ready. 📚\n Please ask another question about this week's reading!"
-        conversation_history[session_id]["messages"].append(("bot", text))
+        append_bot_message(session_id, text)
         return jsonify(show_buttons(text, session_id))
 
-    if session_id not in conversation_history:
-        conversation_history[session_id] = {"messages": []}
-        summary_cache.pop(session_id, None)
-        processed_pdf.pop(session_id, None)
-        pdf_ready.pop(session_id, None)
-
     # ----------------------------
     # TA Question Workflow
     # ----------------------------
 
     if message == "ask_TA": 
-        conversation_history[session_id]["awaiting_ta_question"] = False
-        conversation_history[session_id].pop("student_question", None)
-        conversation_history[session_id].pop("suggested_question", None)
-        conversation_history[session_id].pop("final_question", None)
-
-        ta_button_response = build_TA_button()
-        ta_button_response["session_id"] = session_id
-        return jsonify(ta_button_response)
+        sess["awaiting_ta_question"] = False
+        sess.pop("student_question", None)
+        sess.pop("suggested_question", None)
+        sess.pop("final_question", None)
+
+        return jsonify(build_TA_button(session_id))
     
-    if message in ["ask_TA_Aya", "ask_TA_Jiyoon"]:
+    if message in TA_BUTTON_MSGS:
         # User selected a TA to ask a question.
-        ta_selected = ""
-        if message == "ask_TA_Jiyoon":
-            ta_selected = "Jiyoon"
-        elif message == "ask_TA_Aya":
-            ta_selected = "Aya"
-        elif message == "ask_TA_Amanda":
-            ta_selected = "Amanda"
-            
+        ta_selected = TA_BUTTON_MSGS[message]
+
         # Initialize question_flow state
-        conversation_history[session_id]["question_flow"] = {
+        sess["question_flow"] = {
             "ta": ta_selected,
             "state": "awaiting_question",  # waiting for the student to type the question
             "raw_question": "",
@@ -527,13 +1068,13 @@ def query():
         })
    
     # Check if we are in the middle of a TA question workflow
-    if conversation_history[session_id].get("question_flow"):
+    if sess.get("question_flow"):
         # If the user types the safeguard exit keyword "exit", cancel the TA flow.
-        if message.lower() == "exit":
-            conversation_history[session_id]["question_flow"] = None
+        if msg_lc == "exit":
+            sess["question_flow"] = None
             return jsonify(show_buttons("Exiting TA query mode. How can I help you with the research paper?", session_id))
     
-        q_flow = conversation_history[session_id]["question_flow"]
+        q_flow = sess["question_flow"]
         state = q_flow.get("state", "")
         
         # State 1: Awaiting the initial question from the student.
@@ -575,26 +1116,19 @@ def query():
         
     # State 2: Awaiting decision from student on whether to refine or send
         if state == "awaiting_decision":
-            if message.lower() == "send":
-                ta_username = ""
-
-                if q_flow["ta"] == "Aya":
-                    ta_username = "aya.ismail"
-                elif q_flow["ta"] == "Jiyoon":
-                    ta_username = "jiyoon.choi"
-                elif q_flow["ta"] == "Amanda":
-                    ta_username = "amanda.wu"
+            if msg_lc == "send":
+                ta_username = TA_USERNAMES.get(q_flow["ta"], "")
 
                 final_question = q_flow.get("suggested_question") or q_flow.get("raw_question")
-                send_direct_message_to_TA(final_question, user, ta_username)
-                conversation_history[session_id]["question_flow"] = None
+                notify(send_direct_message_to_TA, final_question, user, ta_username)
+                sess["question_flow"] = None
                 return jsonify(show_buttons(f"Your question has been sent to TA {q_flow['ta']}!", session_id
                 ))
-            elif message.lower() == "cancel":
-                conversation_history[session_id]["question_flow"] = None
+            elif msg_lc == "cancel":
+                sess["question_flow"] = None
                 return jsonify(show_buttons("Your TA question process has been canceled. Let me know if you need anything else.", session_id
                 ))
-            elif message.lower() == "refine":
+            elif msg_lc == "refine":
                 # Default refine using LLM feedback
                 suggested = generate_suggested_question(session_id, q_flow["raw_question"])[0]
                 q_flow["suggested_question"] = suggested
@@ -613,19 +1147,13 @@ def query():
 
         # Handling the decision in the refinement phase:
         if state == "awaiting_refinement_decision":
-            print(f"DEBUGGING****: {session_id} - {message}")
-            if message.lower() == "approve":
-                ta_username = ""
-                if q_flow["ta"] == "Aya":
-                    ta_username = "aya.ismail"
-                elif q_flow["ta"] == "Jiyoon":
-                    ta_username = "jiyoon.choi"
-                elif q_flow["ta"] == "Amanda":
-                    ta_username = "amanda.wu"
+            logger.debug("%s - %s", session_id, message)
+            if msg_lc == "approve":
+                ta_username = TA_USERNAMES.get(q_flow["ta"], "")
 
                 final_question = q_flow.get("suggested_question") or q_flow.get("raw_question")
-                send_direct_message_to_TA(final_question, user, ta_username)
-                conversation_history[session_id]["question_flow"] = None
+                notify(send_direct_message_to_TA, final_question, user, ta_username)
+                sess["question_flow"] = None
                 payload = show_buttons(
                     f"Your question has been sent to TA {q_flow['ta']}!",
                     session_id
@@ -633,13 +1161,13 @@ def query():
                 payload["attachments"].append(build_refinement_buttons(q_flow))
                 return jsonify(payload)
                
-            elif message.lower() == "modify":
+            elif msg_lc == "modify":
                 q_flow["state"] = "awaiting_feedback"
                 return jsonify({
                     "text": "Please type your feedback for refining your question.",
                     "session_id": session_id
                 }) 
-            elif message.lower() == "manual_edit" or message.startswith("Editing: "):
+            elif msg_lc == "manual_edit" or message.startswith("Editing: "):
                 raw = message.strip()
                 prefix = "Editing: "
                 if raw.startswith(prefix):
@@ -660,8 +1188,8 @@ def query():
                     "session_id": session_id,
                     **build_refinement_buttons(q_flow)
                 })
-            elif message.lower() == "cancel":
-                conversation_history[session_id]["question_flow"] = None
+            elif msg_lc == "cancel":
+                sess["question_flow"] = None
                 return jsonify(show_buttons("Your TA question process has been canceled. Let me know if you need anything else.", session_id
                 ))
             else:
@@ -683,41 +1211,35 @@ def query():
                 "session_id": session_id,
                 **build_refinement_buttons(q_flow)
             })
-    # Look up the student session ID using the mapping.
-
-    if ta_msg_to_student_session:
-        msg_id = next(reversed(ta_msg_to_student_session))
-        student_username = ta_msg_to_student_session[msg_id]
-        student_session_id = f"session_{student_username}_twips_research"
-
-        if not student_session_id:
-            return jsonify({"error": "No student session mapped for this message ID."}), 400
-        
-        if conversation_history[student_session_id].get("awaiting_ta_response"):
+    # Look up the student session ID from the TA's latest forwarded question.
+    # Only TAs can be replying here, so students skip this entirely.
+    if user in TA_USERS and latest_ta_msg:
+        msg_id, student_username = latest_ta_msg
+        student_session_id = get_session_id({"user_name": student_username})
+        student_session = conversation_history.get(student_session_id, {})
+
+        if student_session.get("awaiting_ta_response"):
         # Assume this message is the TA's typed answer.
-            conversation_history[student_session_id]["awaiting_ta_response"] = False
-            conversation_history[student_session_id]["messages"].append(("TA", message))
-            print(f"DEBUG: Received TA reply for session {student_session_id}: {message}")
-            forward_message_to_student(message, session_id, student_session_id)
+            student_session["awaiting_ta_response"] = False
+            student_session["messages"].append(("TA", message))
+            logger.debug("Received TA reply for session %s: %s", student_session_id, message)
+            notify(forward_message_to_student, message, session_id, student_session_id)
             response = f"Your response has been forwarded to student {student_username}."
             return jsonify({"text": response, "session_id": session_id})
-    else:
-        msg_id = None
    
     # ----------------------------
     # End of TA Question Workflow
     # ----------------------------
 
     # only handle the Yes/No confirmation when NOT already in a TA question flow
-    if conversation_history[session_id].pop("awaiting_ta_confirmation", False):
+    if sess.pop("awaiting_ta_confirmation", False):
         # “Yes” or “Ask TA” → start the TA flow
-        if message.lower() in ("yes", "y") or message == "ask_TA":
-            resp = build_TA_button()
-            resp["session_id"] = session_id
-            return jsonify(resp)
+        if msg_lc in ("yes", "y") or message == "ask_TA":
+            return jsonify(build_TA_button(session_id))
         # “No” → fallback to a paper‐based answer
+        # classify while the session's background PDF job finishes, then wait on it
+        difficulty = classify_difficulty(message)
         ensure_pdf_processed(session_id)
-        difficulty = classify_difficulty(message, session_id)
         if difficulty == "factual":
             answer = generate_response(
                 "", f"Answer factually: {message}", session_id
@@ -728,21 +1250,25 @@ def query():
                 f"Answer conceptually in 1-2 sentences, then suggest where to look in the paper for details: {message}", 
                 session_id
             )
-        conversation_history[session_id]["messages"].append(("bot", answer))
+        append_bot_message(session_id, answer)
         return jsonify(show_buttons(answer, session_id, followup_button=True))
     
     # Special admin commands
-    if message.lower() == "clear_history":
-        conversation_history.pop(session_id, None)
-        summary_cache.pop(session_id, None)
-        processed_pdf.pop(session_id, None)
-        pdf_ready.pop(session_id, None)
+    if msg_lc == "clear_history":
+        reset_session(session_id)
         return jsonify(show_buttons("✅ History and caches cleared.", session_id))
 
-    if message.lower() == "summarize":
-        if not ensure_pdf_processed(session_id):
-            return jsonify(show_buttons("PDF not processed yet. Please try again shortly.", session_id))
-        summary = generate_response("", "Summarize the uploaded paper in 3-4 sentences.", session_id)
+    if msg_lc == "summarize":
+        # the paper is the same for everyone, so a summary from any session will do
+        summary = summary_cache.get(session_id) or paper_cache.get("summary")
+        if not summary:
+            if not ensure_pdf_processed(session_id):
+                return jsonify(show_buttons("PDF not processed yet. Please try again shortly.", session_id))
+            summary = generate_response("", "Summarize the uploaded paper in 3-4 sentences.", session_id)
+            if is_llm_error(summary):
+                return jsonify(show_buttons(summary, session_id))
+            paper_cache["summary"] = summary
+            save_paper_cache()
         summary_cache[session_id] = summary
         return jsonify(show_buttons(summary, session_id))
 
@@ -750,219 +1276,66 @@ def query():
     # ----------------------------
     # Follow-up Question Workflow
     # ----------------------------
-    if message.startswith("__FOLLOWUP__ | ") or message.lower() == "generate_followup":
-        # decode last-bot override if present
+    if message.startswith("__FOLLOWUP__ | ") or msg_lc == "generate_followup":
+        # look up the message the button was attached to, if we still have it
         override = None
         if message.startswith("__FOLLOWUP__ | "):
-            _, raw = message.split("|", 1)
-            override = raw.replace("\\n", "\n").replace('\\"', '"')
+            override = followup_sources.get(message[len("__FOLLOWUP__ | "):].strip())
 
         followup = generate_followup(session_id, override_last_bot=override)
-        conversation_history[session_id]["awaiting_followup_response"] = True
-        conversation_history[session_id]["last_followup_question"] = followup
-        conversation_history[session_id]["messages"].append(("bot", followup))
+        sess["awaiting_followup_response"] = True
+        sess["last_followup_question"] = followup
+        append_bot_message(session_id, followup)
         return jsonify({
             "text": f"🧐 Follow-up:\n\n{followup}\n\nPlease reply with your thoughts!",
             "session_id": session_id,
-            "attachments": [{
-                "actions": [{
-                    "type": "button",
-                    "text": "❌ Skip",
-                    "msg": "skip_followup",
-                    "msg_in_chat_window": True,
-                    "msg_processing_type": "sendMessage"
-                }]
-            }]
+            "attachments": [SKIP_FOLLOWUP_BUTTON]
         })
-    if message.lower() == "generate_followup":
+    if msg_lc == "generate_followup":
         # rocket.chat will include the button's "value" field in payload
         override = data.get("value")
         followup = generate_followup(session_id, override)
 
         if followup:
-            conversation_history[session_id]["awaiting_followup_response"] = True
-            conversation_history[session_id]["last_followup_question"] = followup
-            conversation_history[session_id]["messages"].append(("bot", followup))
+            sess["awaiting_followup_response"] = True
+            sess["last_followup_question"] = followup
+            append_bot_message(session_id, followup)
             return jsonify({
                 "text": f"🧐 Follow-up:\n\n{followup}\n\nPlease reply with your thoughts!",
                 "session_id": session_id,
-                "attachments": [{"actions": [{"type": "button", "text": "❌ Skip", "msg": "skip_followup", "msg_in_chat_window": True, "msg_processing_type": "sendMessage"}]}]
+                "attachments": [SKIP_FOLLOWUP_BUTTON]
             })
 
-    cmds = {"summarize", "generate_followup", "clear_history"}
-
-    if conversation_history[session_id].get("awaiting_followup_response") and message.lower() not in cmds:
-        last_followup = conversation_history[session_id].get("last_followup_question", "")
-
-        grading_prompt = (
-            f"Original follow-up question:\n\n"
-            f"\"{last_followup}\"\n\n"
-            f"Student's response:\n\n"
-            f"\"{message}\"\n\n"
-            "Consider the following 2 cases and keep response concise, encouraging, and related to the uploaded paper:\n"
-            "Case 1: If the original follow-up question prompts a concrete answer, evaluate the student's response:\n"
-            "- If correct or mostly correct, confirm warmly and optionally elaborate briefly.\n"
-            "- If partially correct, point out missing parts politely.\n"
-            "- If wrong, gently correct them and guide them where to look in the paper.\n"
-            "Case 2: If the original follow-up question is vague or open-ended, evaluate the student's response:\n"
-            "- If the student provides a concrete answer, confirm warmly and optionally elaborate briefly.\n"
-            "- If the student provides a vague or open-ended answer, gently correct them and guide them where to look in the paper.\n\n"
-        )
+    # a button whose flow has already ended (e.g. an old "approve") is not a question
+    if msg_lc in BUTTON_MSGS or message.startswith("Editing: "):
+        return jsonify(show_buttons(STALE_BUTTON_TEXT, session_id))
+
+    if sess.get("awaiting_followup_response") and msg_lc not in CMDS:
+        last_followup = sess.get("last_followup_question", "")
+
+        grading_prompt = GRADING_PROMPT.format(last_followup=last_followup, message=message)
 
-        feedback = generate_response("", grading_prompt, session_id)
-        conversation_history[session_id]["messages"].append(("bot", feedback))
+        feedback = generate_response(GRADING_SYSTEM, grading_prompt, session_id)
+        append_bot_message(session_id, feedback)
 
         # AFTER generating feedback, then clear flags
-        conversation_history[session_id]["awaiting_followup_response"] = False
-        conversation_history[session_id].pop("last_followup_question", None)
+        sess["awaiting_followup_response"] = False
+        sess.pop("last_followup_question", None)
 
         return jsonify(show_buttons(feedback, session_id, followup_button=True))
             
     # Process normal message
-    conversation_history[session_id]["messages"].append(("user", message))
-    classification = classify_query(message, session_id)
+    sess["messages"].append(("user", message))
+    classification, difficulty, specificity, is_metadata = classify(message)
     # classification_data = classify_message(message, session_id)
     # classification = classification_data["topic"]
     # difficulty = classification_data["difficulty"]
     # specificity = classification_data["specificity"]
 
-    print(f"DEBUG: Classified as {classification}")
-
-    if classification == "greeting":
-        ensure_pdf_processed(session_id)
-        intro = generate_response("", "Give a one-line overview: 'This week's paper discusses...'", session_id)
-
-        greeting_msg = (
-            "**Hello! 👋 I am the TA chatbot for CS-150: Generative AI for Social Impact. 🤖**\n\n"
-            "I'm here to help you *critically analyze ONLY this week's* research paper, which I *encourage you to read* before interacting with me. "
-            "I'll guide you to the key sections and ask thought-provoking questions—but I won't just hand you the answers. 🤫\n\n"
-            f"**{intro}**\n\n"
-            "If there's a question I can't fully answer, I'll prompt you to forward it to your TA. "
-            "Please ask a question about the paper now or click one of the buttons below! "
-            "You have two buttons to choose from:\n"
-            "- 📄 **Quick Summary** - Get a concise 3-4 sentence overview of the paper's main objectives and findings.\n"
-            "- 🧑‍🏫 **Ask TA** - Send your question to a human TA if you'd like extra help.\n\n"
-        )
-
-        conversation_history[session_id]["messages"].append(("bot", greeting_msg))
-        return jsonify(show_buttons(greeting_msg, session_id, summary_button=True))
-
-    if classification == "content_about_paper":
-        ensure_pdf_processed(session_id)
-
-        # Use LLM to detect metadata questions (authors, title, publication, etc.)
-        metadata_prompt = (
-            "Is the following question asking for metadata (authors, title, publication details) "
-            "about the uploaded TwIPS paper? Respond with exactly 'yes' or 'no'.\n\n"
-            f"Question: \"{message}\""
-        )
-        is_metadata = generate_response("", metadata_prompt, session_id).lower().startswith("yes")
-
-        if is_metadata:
-            # Very strict system prompt for metadata
-            system_prompt = (
-                "You are a TA chatbot answering factual metadata questions about the uploaded TwIPS paper. "
-                "ONLY use the title page and first page of the paper. "
-                "Ignore all references or citations. "
-                "If the requested information (like authorship or title) is not clearly stated, say so."
-            )
-            prompt = (
-                "Based solely on the front matter (title page and first page) of the uploaded TwIPS paper, "
-                f"answer the following question:\n\n{message}\n\n"
-                "If the information is unclear, say so politely."
-            )
-            answer = generate(
-                model='4o-mini',
-                system=system_prompt,
-                query=prompt,
-                session_id=session_id,
-                temperature=0.0,
-                lastk=5,
-                rag_usage=True,
-                rag_threshold=0.02,
-                rag_k=10
-            )
-            answer = answer["response"].strip() if isinstance(answer, dict) else answer.strip()
-        else:
-            specificity = classify_specificity(message, session_id)
-            
-            if specificity == "asking_for_details":
-                print("DEBUG: Generating Elusive response about Paper...")
-                answer = generate_paper_response(
-                    "", 
-                    f"The user is asking a general question to learn more about the paper. "
-                    "Give a short teaser (1 sentence) hinting at the answer **only if** it's clearly stated in the paper. "
-                    "Then, point the user to the **specific section title** that most specifically contains the answer (ie. 4.1 Participant Recruiting), and bold it using Markdown (**like this**). ",
-                    session_id
-                )
-                
-            else:
-                difficulty = classify_difficulty(message, session_id)
-                if difficulty == "factual":
-                    print("DEBUG: Generating Factual response about Paper...")
-                    answer = generate_paper_response("", f"Answer factually: {message}", session_id)
-                else:
-                    print("DEBUG: Generating Detailed response about Paper...")
-                    answer = generate_paper_response(
-                        "", 
-                        f"Confirm if their understanding is correct. "
-                        "Then, respond with the correct answer of this conceptual question in 2-3 sentences based on the paper. "
-                        "Only include information you are confident is accurate.", 
-                        session_id
-                    )
-
-
-        conversation_history[session_id]["messages"].append(("bot", answer))
-        return jsonify(show_buttons(answer, session_id, followup_button=True))
-
-    if classification == "class_logistics":
-        # Step 1: Try to give a short chatbot answer first
-        short_answer = generate_response(
-            "", 
-            f"You are a TA chatbot for CS-150. The student asked: \"{message}\". "
-            "Give a short, friendly, 1-2 sentence general tip, but do not make up specific class policies. "
-            "If unsure, encourage them to ask the human TA for details.", 
-            session_id
-        )
-        conversation_history[session_id]["messages"].append(("bot", short_answer))
-
-        # Step 2: THEN offer human TA help
-        conversation_history[session_id]["awaiting_ta_confirmation"] = True
-
-        return jsonify({
-            "text": f"{short_answer}\n\nWould you like to ask your TA for more clarification? 🧐",
-            "attachments": [{
-                "actions": [
-                    {
-                        "type": "button",
-                        "text": "✅ Yes, Ask TA",
-                        "msg": "ask_TA",
-                        "value": "yes",
-                        "msg_in_chat_window": True,
-                        "msg_processing_type": "sendMessage"
-                    },
-                    {
-                        "type": "button",
-                        "text": "❌ No",
-                        "msg": "ask_TA",
-                        "value": "no",
-                        "msg_in_chat_window": True,
-                        "msg_processing_type": "sendMessage"
-                    }
-                ]
-            }],
-            "session_id": session_id
-        })
-
-    if classification == "off_topic":
-        text = "🚫 That seems off-topic! Let's focus on the research paper or class logistics."
-        conversation_history[session_id]["messages"].append(("bot", text))
-        return jsonify(show_buttons(text, session_id))
+    logger.debug("Classified as %s", classification)
 
-    # fallback
-    fallback = "❓ I didn't quite catch that. Try asking about the paper!"
-    conversation_history[session_id]["messages"].append(("bot", fallback))
-    return jsonify(show_buttons(fallback, session_id))
+    handler = HANDLERS.get(classification, handle_fallback)
+    return handler(message, session_id, (classification, difficulty, specificity, is_metadata))
 
 # ------------------------------------------------------------------------
 # Server Start
@@ -972,5 +1345,5 @@ def page_not_found(e):
     return "Not Found", 404
 
 if __name__ == "__main__":
-    print("DEBUG: Starting Flask server...")
+    logger.info("Starting Flask server...")
     app.run()
\ No newline at end of file
@@ -1,6 +1,7 @@
 import os
 import json
 import requests
+from requests.adapters import HTTPAdapter
 from dotenv import load_dotenv
 load_dotenv()
 
@@ -8,6 +9,11 @@ load_dotenv()
 end_point = os.environ.get("endPoint")
 api_key = os.environ.get("apiKey")
 
+# Keep-alive connections to the proxy, shared by every request thread
+http_session = requests.Session()
+http_session.mount("https://", HTTPAdapter(pool_connections=10, pool_maxsize=20))
+http_session.mount("http://", HTTPAdapter(pool_connections=10, pool_maxsize=20))
+
 def generate(
 	model: str,
 	system: str,
@@ -40,7 +46,7 @@ def generate(
     msg = None
 
     try:
-        response = requests.post(end_point, headers=headers, json=request)
+        response = http_session.post(end_point, headers=headers, json=request, timeout=120)
 
         if response.status_code == 200:
             res = json.loads(response.text)
@@ -61,7 +67,7 @@ def upload(multipart_form_data):
 
     msg = None
     try:
-        response = requests.post(end_point, headers=headers, files=multipart_form_data)
+        response = http_session.post(end_point, headers=headers, files=multipart_form_data)
         
         if response.status_code == 200:
             msg = "Successfully uploaded. It may take a short while for the document to be added to your context"
@@ -77,7 +83,8 @@ def pdf_upload(
     path: str,    
     strategy: str | None = None,
     description: str | None = None,
-    session_id: str | None = None
+    session_id: str | None = None,
+    data: bytes | None = None
     ):
     
     params = {
@@ -86,9 +93,14 @@ def pdf_upload(
         'strategy': strategy
     }
 
+    # callers uploading the same file repeatedly can pass its bytes in data
+    if data is None:
+        with open(path, 'rb') as f:
+            data = f.read()
+
     multipart_form_data = {
         'params': (None, json.dumps(params), 'application/json'),
-        'file': (None, open(path, 'rb'), "application/pdf")
+        'file': (None, data, "application/pdf")
     }
 
     response = upload(multipart_form_data)
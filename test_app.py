@@ -0,0 +1,170 @@
+import threading
+import time
+import unittest
+from collections import deque
+from unittest import mock
+
+import app
+
+
+class PaperQuestionTest(unittest.TestCase):
+    """
+    The paper answer runs in the student's llmproxy session, which no longer
+    holds the question (classification has its own session), so the query
+    itself has to carry it.
+    """
+
+    SESSION_ID = "session_test.student_twips_research"
+    QUESTION = "Does TwIPS flag sarcasm in messages?"
+
+    def setUp(self):
+        app.conversation_history[self.SESSION_ID] = {"messages": deque(maxlen=app.MAX_HISTORY)}
+
+    def tearDown(self):
+        app.conversation_history.pop(self.SESSION_ID, None)
+
+    def ask(self, difficulty, specificity):
+        generate = mock.Mock(return_value={"response": "answer", "rag_context": ""})
+        with mock.patch.object(app, "generate", generate), \
+                mock.patch.object(app, "ensure_pdf_processed", return_value=True), \
+                app.app.test_request_context():
+            labels = ("content_about_paper", difficulty, specificity, False)
+            app.handle_paper_question(self.QUESTION, self.SESSION_ID, labels)
+        generate.assert_called_once()
+        return generate.call_args.kwargs["query"]
+
+    def test_teaser_query_includes_question(self):
+        self.assertIn(self.QUESTION, self.ask("conceptual", "asking_for_details"))
+
+    def test_factual_query_includes_question(self):
+        self.assertIn(self.QUESTION, self.ask("factual", "confirming_understanding"))
+
+    def test_conceptual_query_includes_question(self):
+        self.assertIn(self.QUESTION, self.ask("conceptual", "confirming_understanding"))
+
+
+class LocalRoutingTest(unittest.TestCase):
+    """
+    The local patterns decide whether the classifier is called at all, so a
+    message they claim must really be a greeting, acknowledgement or class
+    logistics question, and paper questions must reach the LLM.
+    """
+
+    LLM_LABELS = '{"category": "content_about_paper", "difficulty": "conceptual", ' \
+                 '"specificity": "asking_for_details", "metadata": false}'
+
+    LOCAL = [
+        ("hi", "greeting"),
+        ("Hello there!", "greeting"),
+        ("good  morning", "greeting"),
+        ("thanks!", "acknowledgement"),
+        ("ok", "acknowledgement"),
+        ("got it", "acknowledgement"),
+        ("When is the deadline?", "class_logistics"),
+        ("What are the TA office hours?", "class_logistics"),
+        ("Can I get an extension on the project?", "class_logistics"),
+        ("When is our presentation?", "class_logistics"),
+    ]
+
+    CLASSIFIER = [
+        "How do the TwIPS presentations of tone differ?",
+        "Did they test browser extensions?",
+        "What extensions to the system do they propose?",
+        "How was grading done in the study?",
+        "hi, what is the paper about?",
+        "thanks, but why did they use GPT-4?",
+        "Who wrote the paper?",
+    ]
+
+    def setUp(self):
+        app.classification_cache.clear()
+
+    def classify(self, message):
+        with mock.patch.object(app, "generate_classifier", return_value=self.LLM_LABELS) as classifier:
+            labels = app.classify(message)
+        return labels, classifier.called
+
+    def test_local_matches_skip_classifier(self):
+        for message, category in self.LOCAL:
+            with self.subTest(message=message):
+                labels, called = self.classify(message)
+                self.assertEqual(labels[0], category)
+                self.assertFalse(called)
+
+    def test_paper_questions_reach_classifier(self):
+        for message in self.CLASSIFIER:
+            with self.subTest(message=message):
+                labels, called = self.classify(message)
+                self.assertEqual(labels[0], "content_about_paper")
+                self.assertTrue(called)
+
+    def test_metadata_shortcut_only_matches_whole_questions(self):
+        cases = [
+            ("Who wrote the paper?", True),
+            ("who are the authors of this paper", True),
+            ("What's the title of the paper?", True),
+            ("What is the title of this study", True),
+            ("Why did the authors pick 12 participants?", False),
+            ("What's the title of section 4 about?", False),
+            ("Who wrote the paper and why?", False),
+        ]
+        for message, expected in cases:
+            with self.subTest(message=message):
+                self.assertEqual(bool(app.META_RE.match(message)), expected)
+
+
+class SingleFlightTest(unittest.TestCase):
+    """
+    Identical generate_response calls made while one is in flight share its
+    upstream request, its result and its exception.
+    """
+
+    def run_pair(self, side_effect):
+        started = threading.Event()
+        release = threading.Event()
+
+        def blocking_generate(**kwargs):
+            started.set()
+            release.wait(5)
+            return side_effect()
+
+        generate = mock.Mock(side_effect=blocking_generate)
+        results = [None, None]
+
+        def call(i):
+            try:
+                results[i] = app.generate_response("system", "prompt", "session_single_flight")
+            except Exception as e:
+                results[i] = e
+
+        with mock.patch.object(app, "generate", generate):
+            leader = threading.Thread(target=call, args=(0,))
+            follower = threading.Thread(target=call, args=(1,))
+            leader.start()
+            self.assertTrue(started.wait(5))
+            follower.start()
+            time.sleep(0.1)  # let the follower find the leader's Future
+            release.set()
+            leader.join(5)
+            follower.join(5)
+        self.assertEqual(generate.call_count, 1)
+        self.assertEqual(app.inflight, {})
+        return results
+
+    def test_follower_shares_result(self):
+        results = self.run_pair(lambda: {"response": " shared answer ", "rag_context": ""})
+        self.assertEqual(results, ["shared answer", "shared answer"])
+
+    def test_follower_shares_exception(self):
+        error = RuntimeError("proxy down")
+
+        def fail():
+            raise error
+
+        results = self.run_pair(fail)
+        self.assertIs(results[0], error)
+        self.assertIs(results[1], error)
+
+
+if __name__ == "__main__":
+    unittest.main()